@@ -8,7 +8,7 @@ import plistlib
 import random
 import string
 from types import SimpleNamespace
-from typing import Dict, Optional, cast
+from typing import Dict, List, Optional, Tuple, cast
 
 from pyatv.interface import MediaMetadata
 from pyatv.protocols.dmap import parser
@@ -146,6 +146,7 @@ class FakeRaopState:
         self.volume: float = INITIAL_VOLUME
         self.teardown_called: bool = False
         self.streaming_started: bool = False
+        self._sync_packet_waiters: List[Tuple[int, asyncio.Event]] = []
 
     def is_supported(self, flag: RaopServiceFlags) -> bool:
         """Return if a feature is supported."""
@@ -158,6 +159,21 @@ class FakeRaopState:
         else:
             self.flags &= ~flag
 
+    def notify_on_sync_packets(self, threshold: int) -> asyncio.Event:
+        """Return event that is set when threshold sync packets have been received."""
+        event = asyncio.Event()
+        self._sync_packet_waiters.append((threshold, event))
+        self.sync_packet_received()
+        return event
+
+    def sync_packet_received(self) -> None:
+        """Set events for all sync packet thresholds that have been reached."""
+        for waiter in list(self._sync_packet_waiters):
+            threshold, event = waiter
+            if self.sync_packets_received >= threshold:
+                event.set()
+                self._sync_packet_waiters.remove(waiter)
+
     @property
     def raw_audio(self) -> bytes:
         if not self.audio_packets:
@@ -329,6 +345,7 @@ class ControlServer(asyncio.Protocol):
         # TODO: Only decoding now, should verify some stuff as well
         SyncPacket.decode(data)
         self.state.sync_packets_received += 1
+        self.state.sync_packet_received()
 
     def error_received(self, exc) -> None:
         """Handle a connection error."""
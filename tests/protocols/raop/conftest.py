@@ -1,6 +1,7 @@
 """Shared test code for RAOP test cases."""
 import asyncio
-from typing import cast
+import io
+from typing import Callable, Dict, cast
 
 import pytest
 import pytest_asyncio
@@ -11,6 +12,21 @@ from pyatv.const import Protocol
 
 from tests.fake_device import FakeAppleTV, raop
 from tests.fake_device.raop import FakeRaopUseCases
+from tests.utils import data_path
+
+
+@pytest.fixture(name="wav_cache", scope="session")
+def wav_cache_fixture() -> Callable[[str], io.BytesIO]:
+    """Return buffers for test files, only reading each file from disk once."""
+    cache: Dict[str, bytes] = {}
+
+    def _get(filename: str) -> io.BytesIO:
+        if filename not in cache:
+            with open(data_path(filename), "rb") as source_file:
+                cache[filename] = source_file.read()
+        return io.BytesIO(cache[filename])
+
+    yield _get
 
 
 @pytest_asyncio.fixture(name="raop_device")
@@ -32,10 +48,20 @@ def raop_usecase_fixture(raop_device) -> FakeRaopUseCases:
     yield cast(FakeRaopUseCases, raop_device.get_usecase(Protocol.RAOP))
 
 
+@pytest.fixture(name="raop_client_password")
+def raop_client_password_fixture():
+    """Password used by client, override by parametrizing raop_client_password."""
+    yield None
+
+
 @pytest.fixture(name="raop_conf")
-def raop_conf_fixture(raop_device, raop_properties):
+def raop_conf_fixture(raop_device, raop_properties, raop_client_password):
     service = ManualService(
-        "raop_id", Protocol.RAOP, raop_device.get_port(Protocol.RAOP), raop_properties
+        "raop_id",
+        Protocol.RAOP,
+        raop_device.get_port(Protocol.RAOP),
+        raop_properties,
+        password=raop_client_password,
     )
     conf = AppleTV("127.0.0.1", "Apple TV")
     conf.add_service(service)
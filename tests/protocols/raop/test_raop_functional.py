@@ -10,13 +10,13 @@ import asyncio
 import io
 import logging
 import math
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import pytest
 import pytest_asyncio
 
 from pyatv import connect, exceptions
-from pyatv.const import DeviceState, FeatureName, FeatureState, MediaType, Protocol
+from pyatv.const import DeviceState, FeatureName, FeatureState, MediaType
 from pyatv.exceptions import AuthenticationError
 from pyatv.interface import FeatureInfo, MediaMetadata, Playing, PushListener
 from pyatv.protocols.airplay.utils import dbfs_to_pct
@@ -55,10 +55,25 @@ async def playing_listener_fixture(raop_client):
             self.updates: List[Playing] = []
             self.all_features: Dict[FeatureName, FeatureInfo] = {}
             self.playing_event = asyncio.Event()
+            self._expected_updates: Optional[int] = None
+            self._updates_reached = asyncio.Event()
+
+        async def wait_for_updates(self, updates: int, timeout: float = 5.0) -> None:
+            """Wait until a certain number of updates have been received."""
+            self._expected_updates = updates
+            self._updates_reached.clear()
+            if len(self.updates) >= updates:
+                return
+            await asyncio.wait_for(self._updates_reached.wait(), timeout)
 
         def playstatus_update(self, updater, playstatus: Playing) -> None:
             """Inform about changes to what is currently playing."""
             self.updates.append(playstatus)
+            if (
+                self._expected_updates is not None
+                and len(self.updates) >= self._expected_updates
+            ):
+                self._updates_reached.set()
             if playstatus.device_state == DeviceState.Playing:
                 self.all_features = raop_client.features.all_features()
                 self.playing_event.set()
@@ -70,6 +85,7 @@ async def playing_listener_fixture(raop_client):
     raop_client.push_updater.listener = listener
     raop_client.push_updater.start()
     yield listener
+    raop_client.push_updater.stop()
 
 
 async def audio_matches(
@@ -78,23 +94,42 @@ async def audio_matches(
     channels: int = CHANNELS,
     sample_width: int = SAMPLE_WIDTH,
     skip_frames: int = 0,
-) -> None:
+) -> bool:
     """Assert that raw audio matches audio generated by audiogen.py."""
-    succeeded = True
     frame_size = channels * sample_width
 
     # Wait until there's enough data in the audio buffer for expected number of frames
     await until(lambda: len(audio) >= frames * channels * sample_width)
 
-    # assert per individual frame
-    for i in range(frames):
-        actual = audio[i * frame_size : i * frame_size + frame_size]
-        expected = frame_size * bytes([(i + skip_frames) & 0xFF])
-        if actual != expected:
-            _LOGGER.error("%s != %s for frame %d", actual, expected, (i + skip_frames))
-            succeeded = False
-
-    return succeeded
+    # Frame values repeat every 256 frames, so build one cycle (starting at the first
+    # expected frame) and repeat it to get the complete expected buffer
+    cycle = b"".join(frame_size * bytes([i]) for i in range(256))
+    offset = (skip_frames % 256) * frame_size
+    cycle = cycle[offset:] + cycle[:offset]
+    expected_audio = (cycle * (frames // 256 + 1))[: frames * frame_size]
+    actual_audio = memoryview(audio).cast("B")[: frames * frame_size]
+    if actual_audio == expected_audio:
+        return True
+
+    # Locate first diverging byte by bisecting over prefixes, which keeps all
+    # comparisons in C rather than looping over each frame (slicing views, not copies)
+    expected_view = memoryview(expected_audio)
+    low, high = 0, len(expected_audio)
+    while low < high:
+        middle = (low + high) // 2
+        if actual_audio[: middle + 1] == expected_view[: middle + 1]:
+            low = middle + 1
+        else:
+            high = middle
+
+    frame = low // frame_size
+    _LOGGER.error(
+        "%s != %s for frame %d",
+        bytes(actual_audio[frame * frame_size : (frame + 1) * frame_size]),
+        expected_audio[frame * frame_size : (frame + 1) * frame_size],
+        frame + skip_frames,
+    )
+    return False
 
 
 def assert_features_in_state(
@@ -102,8 +137,9 @@ def assert_features_in_state(
     features: List[FeatureName],
     state: FeatureState,
 ) -> None:
-    for feature in features:
-        assert all_features[feature].state == state
+    assert {feature: all_features[feature].state for feature in features} == {
+        feature: state for feature in features
+    }
 
 
 @pytest.mark.parametrize(
@@ -170,8 +206,8 @@ async def test_stream_complete_file_verify_padding(raop_client, raop_state):
 
     assert len(padding) == total_latency_size_in_bytes
 
-    # Avoid allocating a large buffer to compare with
-    assert padding.replace(b"\x00", b"") == b""
+    # Count zero bytes in place to avoid allocating a large buffer to compare with
+    assert padding.count(0) == len(padding)
 
 
 @pytest.mark.parametrize(
@@ -190,37 +226,30 @@ async def test_stream_complete_legacy_auth(
 
 
 @pytest.mark.parametrize(
-    "raop_properties,raop_server_password,raop_client_password",
-    [
-        ({"et": "0"}, "test", "test"),
-        ({"et": "0"}, None, None),
-        ({"et": "0"}, "test", None),
-    ],
+    "raop_properties,raop_client_password",
+    [({"et": "0"}, "test"), ({"et": "0"}, None)],
 )
-async def test_stream_with_password(
-    raop_state,
-    raop_usecase,
-    raop_conf,
-    raop_server_password,
-    raop_client_password,
-    event_loop,
+async def test_stream_password_match(
+    raop_client, raop_usecase, raop_client_password, wav_cache
 ):
-    raop_usecase.password(raop_server_password)
+    raop_usecase.password(raop_client_password)
+
+    await raop_client.stream.stream_file(wav_cache("audio_10_frames.wav"))
 
-    raop_service = raop_conf.get_service(Protocol.RAOP)
-    if raop_service:
-        raop_service.password = raop_client_password
 
-    expect_error = raop_server_password != raop_client_password
+@pytest.mark.parametrize(
+    "raop_properties,raop_server_password,raop_client_password",
+    [({"et": "0"}, "test", None), ({"et": "0"}, "test", "wrong")],
+)
+async def test_stream_password_mismatch(
+    raop_usecase, raop_conf, raop_server_password, event_loop, wav_cache
+):
+    raop_usecase.password(raop_server_password)
 
     client = await connect(raop_conf, loop=event_loop)
     try:
-        await client.stream.stream_file(data_path("audio_10_frames.wav"))
-        assert not expect_error
-    except AuthenticationError as e:
-        assert expect_error
-    except Exception as e:
-        assert False
+        with pytest.raises(AuthenticationError):
+            await client.stream.stream_file(wav_cache("audio_10_frames.wav"))
     finally:
         await asyncio.gather(*client.close())
 
@@ -255,11 +284,11 @@ async def test_stream_retransmission(
 
 
 @pytest.mark.parametrize("raop_properties", [({"et": "0"})])
-async def test_push_updates(raop_client, playing_listener):
-    await raop_client.stream.stream_file(data_path("only_metadata.wav"))
+async def test_push_updates(raop_client, playing_listener, wav_cache):
+    await raop_client.stream.stream_file(wav_cache("only_metadata.wav"))
 
     # Initial idle + audio playing + back to idle
-    await until(lambda: len(playing_listener.updates) == 3)
+    await playing_listener.wait_for_updates(3)
 
     idle = playing_listener.updates[0]
     assert idle.device_state == DeviceState.Idle
@@ -288,7 +317,7 @@ async def test_push_updates_progress(raop_client, playing_listener):
     await raop_client.stream.stream_file(data_path("static_3sec.ogg"))
 
     # Initial idle + audio playing + back to idle
-    await until(lambda: len(playing_listener.updates) == 3)
+    await playing_listener.wait_for_updates(3)
 
     playing = playing_listener.updates[1]
     assert playing.device_state == DeviceState.Playing
@@ -303,7 +332,7 @@ async def test_push_updates_progress(raop_client, playing_listener):
 
 
 @pytest.mark.parametrize("raop_properties", [({"et": "0"})])
-async def test_metadata_features(raop_client, playing_listener):
+async def test_metadata_features(raop_client, playing_listener, wav_cache):
     # All features should be unavailable when nothing is playing
     assert_features_in_state(
         raop_client.features.all_features(),
@@ -316,11 +345,11 @@ async def test_metadata_features(raop_client, playing_listener):
         raop_client.features.get_feature(FeatureName.StreamFile).state
         == FeatureState.Available
     )
-    await raop_client.stream.stream_file(data_path("only_metadata.wav"))
+    await raop_client.stream.stream_file(wav_cache("only_metadata.wav"))
 
     # Use a listener to catch when something starts playing and save that as it's
     # too late to verify when stream_file returns (idle state will be reported).
-    await until(lambda: playing_listener.all_features)
+    await playing_listener.playing_event.wait()
 
     # When playing, everything should be available
     assert_features_in_state(
@@ -331,7 +360,7 @@ async def test_metadata_features(raop_client, playing_listener):
 
 
 @pytest.mark.parametrize("raop_properties", [({"et": "0"})])
-async def test_remote_control_features(raop_client, playing_listener):
+async def test_remote_control_features(raop_client, playing_listener, wav_cache):
     assert_features_in_state(
         raop_client.features.all_features(),
         REMOTE_CONTROL_FIELDS,
@@ -340,7 +369,7 @@ async def test_remote_control_features(raop_client, playing_listener):
 
     # Start playback in the background
     future = asyncio.ensure_future(
-        raop_client.stream.stream_file(data_path("audio_3_packets.wav"))
+        raop_client.stream.stream_file(wav_cache("audio_3_packets.wav"))
     )
 
     # Wait for device to move to playing state and verify feature state
@@ -362,21 +391,23 @@ async def test_remote_control_features(raop_client, playing_listener):
 
 
 @pytest.mark.parametrize("raop_properties", [({"et": "0"})])
-async def test_sync_packets(raop_client, raop_state):
-    await raop_client.stream.stream_file(data_path("only_metadata.wav"))
+async def test_sync_packets(raop_client, raop_state, wav_cache):
+    await raop_client.stream.stream_file(wav_cache("only_metadata.wav"))
 
     # TODO: This test doesn't really test anything, just makes sure that sync packets
     # are received. Expand this test in the future.
-    await until(lambda: raop_state.sync_packets_received > 5)
+    await asyncio.wait_for(raop_state.notify_on_sync_packets(6).wait(), 5)
 
 
 @pytest.mark.parametrize(
     "raop_properties,feedback_supported", [({"et": "0"}, True), ({"et": "0"}, False)]
 )
-async def test_send_feedback(raop_client, raop_usecase, raop_state, feedback_supported):
+async def test_send_feedback(
+    raop_client, raop_usecase, raop_state, feedback_supported, wav_cache
+):
     raop_usecase.feedback_enabled(feedback_supported)
 
-    await raop_client.stream.stream_file(data_path("audio_3_packets.wav"))
+    await raop_client.stream.stream_file(wav_cache("audio_3_packets.wav"))
 
     # One request is sent to see if feedback is supported, then additional requests are
     # only sent if actually supported
@@ -386,44 +417,49 @@ async def test_send_feedback(raop_client, raop_usecase, raop_state, feedback_sup
         assert raop_state.feedback_packets_received == 1
 
 
-@pytest.mark.parametrize("raop_properties", [({"et": "0"})])
-async def test_set_volume_prior_to_streaming(raop_client, raop_state):
-    # Initial client sound level
-    assert math.isclose(raop_client.audio.volume, 33.0)
-
-    await raop_client.audio.set_volume(60)
-    assert math.isclose(raop_client.audio.volume, 60)
-
-    await raop_client.stream.stream_file(data_path("only_metadata.wav"))
-    assert math.isclose(raop_state.volume, -12.0)
-
-
 @pytest.mark.parametrize(
-    "raop_properties,initial_level_supported,sender_expected,receiver_expected",
+    "raop_properties,initial_level_supported,receiver_initial,client_volume,"
+    "sender_expected,receiver_expected",
     [
+        # Volume set by client prior to streaming
+        ({"et": "0"}, False, None, 60.0, 60.0, -12.0),
         # Device supports default level: use that
-        ({"et": "0"}, True, 50.0, -15.0),
+        ({"et": "0"}, True, None, None, 50.0, -15.0),
         # Device does NOT support default level: use pyatv default
-        ({"et": "0"}, False, 33.0, -20.1),
+        ({"et": "0"}, False, None, None, 33.0, -20.1),
+        # Receiver is muted
+        ({"et": "0"}, True, -144.0, None, 0.0, -144.0),
+        # Client mutes prior to streaming
+        ({"et": "0"}, False, None, 0.0, 0.0, -144.0),
     ],
 )
-async def test_use_default_volume_from_device(
+async def test_volume_matrix(
     raop_client,
     raop_state,
     raop_usecase,
     initial_level_supported,
+    receiver_initial,
+    client_volume,
     sender_expected,
     receiver_expected,
+    wav_cache,
 ):
     raop_usecase.initial_audio_level_supported(initial_level_supported)
 
+    if receiver_initial is None:
+        # Default level on remote device
+        assert math.isclose(raop_state.volume, -15.0)
+    else:
+        raop_state.volume = receiver_initial
+
     # Prior to streaming, we don't know the volume of the receiver so return default level
     assert math.isclose(raop_client.audio.volume, 33.0)
 
-    # Default level on remote device
-    assert math.isclose(raop_state.volume, -15.0)
+    if client_volume is not None:
+        await raop_client.audio.set_volume(client_volume)
+        assert math.isclose(raop_client.audio.volume, client_volume)
 
-    await raop_client.stream.stream_file(data_path("only_metadata.wav"))
+    await raop_client.stream.stream_file(wav_cache("only_metadata.wav"))
 
     # Level on the client and receiver should match now
     assert math.isclose(raop_state.volume, receiver_expected)
@@ -431,13 +467,15 @@ async def test_use_default_volume_from_device(
 
 
 @pytest.mark.parametrize("raop_properties", [({"et": "0"})])
-async def test_set_volume_during_playback(raop_client, raop_state, playing_listener):
+async def test_set_volume_during_playback(
+    raop_client, raop_state, playing_listener, wav_cache
+):
     # Set maximum volume as initial volume
     await raop_client.audio.set_volume(100.0)
 
     # Start playback in the background
     future = asyncio.ensure_future(
-        raop_client.stream.stream_file(data_path("audio_3_packets.wav"))
+        raop_client.stream.stream_file(wav_cache("audio_3_packets.wav"))
     )
 
     # Wait for device to move to playing state and verify volume
@@ -488,14 +526,14 @@ async def test_volume_up_volume_down(raop_client, iface):
 
 
 @pytest.mark.parametrize("raop_properties", [({"et": "0"})])
-async def test_only_allow_one_stream_at_the_time(raop_client):
+async def test_only_allow_one_stream_at_the_time(raop_client, wav_cache):
     # This is not pretty, but the idea is to start two concurrent streaming tasks, wait
     # for them to finish and verify that one of them raised an exception. This is to
     # avoid making any assumptions regarding in which order they are scheduled on the
     # event loop.
     result = await asyncio.gather(
-        raop_client.stream.stream_file(data_path("audio_3_packets.wav")),
-        raop_client.stream.stream_file(data_path("only_metadata.wav")),
+        raop_client.stream.stream_file(wav_cache("audio_3_packets.wav")),
+        raop_client.stream.stream_file(wav_cache("only_metadata.wav")),
         return_exceptions=True,
     )
 
@@ -505,44 +543,27 @@ async def test_only_allow_one_stream_at_the_time(raop_client):
 
 
 @pytest.mark.parametrize("raop_properties", [({"et": "0"})])
-async def test_muted_volume_from_receiver(raop_client, raop_state, raop_usecase):
-    raop_usecase.initial_audio_level_supported(True)
-    raop_state.volume = -144.0
-
-    await raop_client.stream.stream_file(data_path("only_metadata.wav"))
-
-    assert math.isclose(raop_client.audio.volume, 0.0)
-
-
-@pytest.mark.parametrize("raop_properties", [({"et": "0"})])
-async def test_mute_volume_from_client(raop_client, raop_state):
-    await raop_client.audio.set_volume(0.0)
-
-    await raop_client.stream.stream_file(data_path("only_metadata.wav"))
-
-    assert math.isclose(raop_state.volume, -144.0)
-
-
-@pytest.mark.parametrize("raop_properties", [({"et": "0"})])
-async def test_device_not_supporting_info_requests(raop_client, raop_usecase):
+async def test_device_not_supporting_info_requests(
+    raop_client, raop_usecase, wav_cache
+):
     raop_usecase.supports_info(False)
 
     # Should just not crash with an error if endpoint is not supported
-    await raop_client.stream.stream_file(data_path("only_metadata.wav"))
+    await raop_client.stream.stream_file(wav_cache("only_metadata.wav"))
 
 
 @pytest.mark.parametrize("raop_properties", [({"et": "0"})])
-async def test_teardown_called_after_playback(raop_client, raop_state):
-    await raop_client.stream.stream_file(data_path("only_metadata.wav"))
+async def test_teardown_called_after_playback(raop_client, raop_state, wav_cache):
+    await raop_client.stream.stream_file(wav_cache("only_metadata.wav"))
     assert raop_state.teardown_called
 
 
 @pytest.mark.parametrize("raop_properties", [({"et": "0", "md": "0,1"})])
-async def test_custom_metadata(raop_client, raop_state):
+async def test_custom_metadata(raop_client, raop_state, wav_cache):
     metadata = MediaMetadata(title="A", artist="B", album="C", artwork=b"abcd")
 
     await raop_client.stream.stream_file(
-        data_path("only_metadata.wav"), metadata=metadata
+        wav_cache("only_metadata.wav"), metadata=metadata
     )
 
     # Note: duration cannot be changed here
@@ -553,11 +574,11 @@ async def test_custom_metadata(raop_client, raop_state):
 
 
 @pytest.mark.parametrize("raop_properties", [({"et": "0", "md": "0"})])
-async def test_custom_metadata_no_artwork(raop_client, raop_state):
+async def test_custom_metadata_no_artwork(raop_client, raop_state, wav_cache):
     metadata = MediaMetadata(artwork=b"abcd")
 
     await raop_client.stream.stream_file(
-        data_path("only_metadata.wav"), metadata=metadata
+        wav_cache("only_metadata.wav"), metadata=metadata
     )
 
     assert raop_state.metadata.artwork is None
@@ -576,10 +597,21 @@ async def test_custom_metadata_override_missing(raop_client, raop_state):
     assert raop_state.metadata.album == "C"
 
 
-@pytest.mark.parametrize("raop_properties", [({"et": "0", "md": "0"})])
-async def test_stream_from_buffer(raop_client, raop_state):
-    with io.open(data_path("audio_1_packet_metadata.wav"), "rb") as source_file:
-        await raop_client.stream.stream_file(source_file)
+@pytest.mark.parametrize(
+    "raop_properties,file_handle",
+    [
+        # Real file object (io.BufferedReader)
+        ({"et": "0", "md": "0"}, True),
+        # In-memory buffer (io.BytesIO)
+        ({"et": "0", "md": "0"}, False),
+    ],
+)
+async def test_stream_from_buffer(raop_client, raop_state, wav_cache, file_handle):
+    if file_handle:
+        with io.open(data_path("audio_1_packet_metadata.wav"), "rb") as source_file:
+            await raop_client.stream.stream_file(source_file)
+    else:
+        await raop_client.stream.stream_file(wav_cache("audio_1_packet_metadata.wav"))
 
     assert raop_state.metadata.artist == "postlund"
     assert raop_state.metadata.album == "raop"
@@ -627,14 +659,14 @@ async def test_stream_metadata_from_http(
 
 @pytest.mark.parametrize("raop_properties", [({"et": "0", "md": "0"})])
 async def test_stream_volume_set_after_stream_start(
-    raop_client, raop_state, raop_usecase
+    raop_client, raop_state, raop_usecase, wav_cache
 ):
     raop_usecase.delayed_set_volume(True)
 
     volume = 9
 
     await raop_client.audio.set_volume(volume)
-    await raop_client.stream.stream_file(data_path("audio_1_packet_metadata.wav"))
+    await raop_client.stream.stream_file(wav_cache("audio_1_packet_metadata.wav"))
 
     assert math.isclose(raop_client.audio.volume, volume)
     assert math.isclose(dbfs_to_pct(raop_state.volume), volume)